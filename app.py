@@ -1,7 +1,16 @@
+import base64
+import binascii
+import hashlib
+import json
+import mmap
 import os
 import sqlite3
-import time
-from flask import Flask, render_template, request, jsonify
+import tempfile
+import threading
+from collections import OrderedDict
+
+import orjson
+from flask import Flask, Response, render_template, request, stream_with_context
 
 app = Flask(__name__)
 
@@ -12,13 +21,208 @@ DB_PATH = os.path.join(BASE_DIR, "hainyu.db")
 MARK_DIR = os.path.join(BASE_DIR, "static", "mark_images")
 os.makedirs(MARK_DIR, exist_ok=True)
 
+# マーク画像として受け付ける拡張子（それ以外は .jpg 扱い）
+MARK_IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"})
+
+
+# ===== SQL =====
+# よく使う SQL はモジュール定数にしておく（sqlite3 のステートメントキャッシュに乗せる）
+
+SQL_GET_HAINYU = """
+SELECT json_object(
+    'header', json_object(
+        'hainyu_id', h.hainyu_id,
+        'date',      h.date,
+        'shipper',   h.shipper,
+        'dest',      h.dest,
+        'itemName',  h.item_name,
+        'mark',      h.mark,
+        'markImage', h.mark_image
+    ),
+    'items', json((
+        SELECT json_group_array(json_object(
+            'id',          i.id,
+            'packageType', i.package_type,
+            'noFrom',      i.no_from,
+            'noTo',        i.no_to,
+            'qty',         i.qty,
+            'L',           i.L,
+            'W',           i.W,
+            'H',           i.H,
+            'weightKg',    i.weight_kg,
+            'm3',          i.m3
+        ))
+        FROM (
+            SELECT *
+            FROM hainyu_items
+            WHERE hainyu_id = h.hainyu_id
+            ORDER BY id
+        ) AS i
+    ))
+)
+FROM hainyu_headers h
+WHERE h.hainyu_id = ?
+"""
+
+SQL_GET_ITEMS_HASH = "SELECT items_hash FROM hainyu_headers WHERE hainyu_id = ?"
+
+SQL_UPSERT_HEADER = """
+INSERT INTO hainyu_headers (hainyu_id, date, shipper, dest, item_name, mark)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(hainyu_id) DO UPDATE SET
+  date      = excluded.date,
+  shipper   = excluded.shipper,
+  dest      = excluded.dest,
+  item_name = excluded.item_name,
+  mark      = excluded.mark
+"""
+
+# 明細から求める集計値（ヘッダーに持たせて一覧で集計し直さないようにする）
+_ITEM_TOTALS_SET = """
+    item_count   = (SELECT COUNT(*) FROM hainyu_items i
+                    WHERE i.hainyu_id = hainyu_headers.hainyu_id),
+    total_qty    = (SELECT COALESCE(SUM(i.qty), 0) FROM hainyu_items i
+                    WHERE i.hainyu_id = hainyu_headers.hainyu_id),
+    total_m3     = (SELECT COALESCE(SUM(i.m3), 0) FROM hainyu_items i
+                    WHERE i.hainyu_id = hainyu_headers.hainyu_id),
+    total_weight = (SELECT COALESCE(SUM(i.qty * i.weight_kg), 0) FROM hainyu_items i
+                    WHERE i.hainyu_id = hainyu_headers.hainyu_id)
+"""
+
+SQL_UPDATE_ITEMS_HASH = """
+UPDATE hainyu_headers SET
+    items_hash = ?,""" + _ITEM_TOTALS_SET + """
+WHERE hainyu_id = ?
+"""
+
+SQL_DELETE_ITEMS = "DELETE FROM hainyu_items WHERE hainyu_id = ?"
+
+# 明細 1 行分の INSERT（executemany でまとめて流す）
+SQL_INSERT_ITEM = """
+INSERT INTO hainyu_items (
+    hainyu_id,
+    package_type,
+    no_from,
+    no_to,
+    qty,
+    L,
+    W,
+    H,
+    weight_kg,
+    m3
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# ヘッダーが無い場合は mark_image だけのヘッダーを作る（他の列は NULL のまま）
+SQL_UPSERT_MARK_IMAGE = """
+INSERT INTO hainyu_headers (hainyu_id, mark_image)
+VALUES (?, ?)
+ON CONFLICT(hainyu_id) DO UPDATE SET
+  mark_image = excluded.mark_image
+"""
+
+# 列名は API のキー名（camelCase）で返し、dict(row) がそのままレスポンスになるようにする
+_SEARCH_SELECT = """
+SELECT
+    hainyu_id AS "hainyuId",
+    date,
+    shipper,
+    dest,
+    item_name AS "itemName",
+    date      AS "lastUpdated"
+FROM hainyu_headers
+"""
+_SEARCH_ORDER = " ORDER BY date DESC, hainyu_id ASC LIMIT 100"
+
+SQL_SEARCH = _SEARCH_SELECT + _SEARCH_ORDER
+
+SQL_SEARCH_FTS = _SEARCH_SELECT + """
+WHERE rowid IN (
+    SELECT rowid FROM hainyu_fts WHERE hainyu_fts MATCH ?
+)
+""" + _SEARCH_ORDER
+
+SQL_SEARCH_LIKE = _SEARCH_SELECT + """
+WHERE
+    hainyu_id LIKE ?
+    OR shipper LIKE ?
+    OR dest LIKE ?
+    OR item_name LIKE ?
+    OR mark LIKE ?
+""" + _SEARCH_ORDER
+
+# 一覧 / 集計（WHERE は条件に応じて間に挟む）
+SQL_SUMMARY_BASE = """
+SELECT
+    hainyu_id                   AS "hainyuId",
+    date,
+    shipper,
+    dest,
+    item_name                   AS "itemName",
+    item_count                  AS "itemCount",
+    total_qty                   AS "totalQty",
+    IFNULL(total_m3, 0.0)       AS "totalM3",
+    IFNULL(total_weight, 0.0)   AS "totalWeight",
+    mark_image                  AS "markImage"
+FROM hainyu_headers
+"""
+
+SQL_SUMMARY_TAIL = """
+ORDER BY
+    date DESC,
+    hainyu_id ASC
+LIMIT ?
+"""
+
+# 一覧 1 回あたりの最大件数
+SUMMARY_LIMIT = 500
+
 
 # ===== DB 初期化 =====
 
+# スキーマの版数（init_db のマイグレーションを追加したら上げる）
+SCHEMA_VERSION = 5
+
+# 全文検索（hainyu_fts）が使えるか（init_db で決まる）
+FTS_ENABLED = False
+
+
+def add_column(cur, table, column_def):
+    """ALTER TABLE ... ADD COLUMN（user_version 導入前のDBで既にある列は無視する）"""
+    try:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+    except sqlite3.OperationalError as e:
+        if "duplicate column" not in str(e):
+            raise
+
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
+    # ページサイズは新規DBのときだけ効く（既存DBでは無視される）。WAL にする前に設定する
+    cur.execute("PRAGMA page_size=8192")
+
+    # WAL はDBファイルに記録され永続するので、起動時に一度だけ設定する
+    cur.execute("PRAGMA journal_mode=WAL")
+
+    # スキーマの版数は PRAGMA user_version で管理し、最新ならマイグレーションは飛ばす
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    if version < SCHEMA_VERSION:
+        migrate(cur, version)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    global FTS_ENABLED
+    FTS_ENABLED = init_fts(cur)
+
+    conn.commit()
+    conn.close()
+
+
+def migrate(cur, version):
+    """user_version が version のDBを SCHEMA_VERSION まで上げる"""
     # ヘッダー情報テーブル
     cur.execute(
         """
@@ -52,27 +256,206 @@ def init_db():
         """
     )
 
-    # 既存DBに mark_image カラムが無ければ追加
-    cur.execute("PRAGMA table_info(hainyu_headers)")
-    cols = [row[1] for row in cur.fetchall()]
-    if "mark_image" not in cols:
-        cur.execute("ALTER TABLE hainyu_headers ADD COLUMN mark_image TEXT")
+    # v1: マーク画像のパス
+    if version < 1:
+        add_column(cur, "hainyu_headers", "mark_image TEXT")
 
-    conn.commit()
-    conn.close()
+    # v2: 明細内容のハッシュ（変更が無ければ明細の削除・再挿入を省く）
+    if version < 2:
+        add_column(cur, "hainyu_headers", "items_hash TEXT")
+
+    # v3: インデックス（明細の JOIN / 削除と、一覧の ORDER BY date DESC 用）
+    if version < 3:
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_items_hainyu_id ON hainyu_items(hainyu_id)"
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_headers_date
+            ON hainyu_headers(date DESC, hainyu_id)
+            """
+        )
+
+    # v4: キーワード検索用の全文検索テーブル（init_fts で作成・確認する）
+
+    # v5: 明細の集計値をヘッダーに持たせ、既存データの分を計算しておく
+    if version < 5:
+        add_column(cur, "hainyu_headers", "item_count INTEGER DEFAULT 0")
+        add_column(cur, "hainyu_headers", "total_qty INTEGER DEFAULT 0")
+        add_column(cur, "hainyu_headers", "total_m3 REAL DEFAULT 0")
+        add_column(cur, "hainyu_headers", "total_weight REAL DEFAULT 0")
+        cur.execute("UPDATE hainyu_headers SET" + _ITEM_TOTALS_SET)
+
+
+# 全文検索のトリガー名
+FTS_TRIGGERS = ("hainyu_fts_ai", "hainyu_fts_ad", "hainyu_fts_au")
+
+
+def init_fts(cur):
+    """全文検索テーブル（hainyu_headers の外部コンテンツ）とトリガーを用意する。使えれば True
+
+    trigram トークナイザ（3 文字以上なら LIKE '%q%' 相当の部分一致）は SQLite 3.34 以降が必要。
+    FTS5 / trigram が使えない環境ではトリガーを外して（ヘッダーの書き込みを止めないため）
+    False を返し、検索は LIKE で行う。
+    """
+    try:
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS hainyu_fts USING fts5(
+                hainyu_id,
+                shipper,
+                dest,
+                item_name,
+                mark,
+                content='hainyu_headers',
+                content_rowid='rowid',
+                tokenize='trigram'
+            )
+            """
+        )
+        # 既存テーブルでもトークナイザが読み込めるか確認する
+        cur.execute("SELECT rowid FROM hainyu_fts LIMIT 1")
+    except sqlite3.OperationalError:
+        for name in FTS_TRIGGERS:
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+        return False
+
+    placeholders = ", ".join("?" * len(FTS_TRIGGERS))
+    cur.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({placeholders})",
+        FTS_TRIGGERS,
+    )
+    if cur.fetchone()[0] == len(FTS_TRIGGERS):
+        return True
+
+    # hainyu_headers の変更を hainyu_fts に反映するトリガー
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS hainyu_fts_ai AFTER INSERT ON hainyu_headers
+        BEGIN
+            INSERT INTO hainyu_fts (rowid, hainyu_id, shipper, dest, item_name, mark)
+            VALUES (new.rowid, new.hainyu_id, new.shipper, new.dest, new.item_name, new.mark);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS hainyu_fts_ad AFTER DELETE ON hainyu_headers
+        BEGIN
+            INSERT INTO hainyu_fts (hainyu_fts, rowid, hainyu_id, shipper, dest, item_name, mark)
+            VALUES ('delete', old.rowid, old.hainyu_id, old.shipper, old.dest, old.item_name, old.mark);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS hainyu_fts_au
+        AFTER UPDATE OF hainyu_id, shipper, dest, item_name, mark ON hainyu_headers
+        BEGIN
+            INSERT INTO hainyu_fts (hainyu_fts, rowid, hainyu_id, shipper, dest, item_name, mark)
+            VALUES ('delete', old.rowid, old.hainyu_id, old.shipper, old.dest, old.item_name, old.mark);
+            INSERT INTO hainyu_fts (rowid, hainyu_id, shipper, dest, item_name, mark)
+            VALUES (new.rowid, new.hainyu_id, new.shipper, new.dest, new.item_name, new.mark);
+        END
+        """
+    )
+
+    # 新しく作った / トリガーが外れていた間の変更を取り込むため、今あるヘッダーから索引を作り直す
+    cur.execute("INSERT INTO hainyu_fts (hainyu_fts) VALUES ('rebuild')")
+    return True
 
 
 # モジュール読み込み時に一度だけ実行
 init_db()
 
 
+# スレッドごとに 1 本のコネクションを使い回す
+_local = threading.local()
+
+
 def get_db():
-    """毎回新しいコネクションを返す簡易版"""
-    conn = sqlite3.connect(DB_PATH)
+    """スレッドごとにキャッシュしたコネクションを返す
+
+    isolation_level=None（autocommit）にして、トランザクションは
+    必要な箇所で BEGIN / COMMIT を明示する。
+    接続はスレッドの寿命の間使い回すので、呼び出し側で close しないこと。
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=256)
     conn.row_factory = sqlite3.Row
+
+    # 接続ごとの設定（journal_mode=WAL は init_db で設定済み。
+    # WAL 前提で synchronous=NORMAL、ページキャッシュは 64MiB、読み込みは 256MiB まで mmap）
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+    _local.conn = conn
     return conn
 
 
+@app.teardown_appcontext
+def reset_db(exc):
+    """リクエスト終了時、途中で残ったトランザクションだけ片付ける（接続は閉じない）"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+# ===== 検索 / 一覧レスポンスのキャッシュ =====
+# キーにはヘッダー・明細の版数（_hdr_version）を含め、書き込みのたびに版数を上げて無効化する。
+# プロセス内キャッシュなので、複数プロセスで動かす場合は版数がプロセス間で共有されない点に注意。
+
+_RESPONSE_CACHE_SIZE = 256
+_response_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_hdr_version = 0
+
+
+def cache_get(key):
+    with _cache_lock:
+        body = _response_cache.get(key)
+        if body is not None:
+            _response_cache.move_to_end(key)
+        return body
+
+
+def cache_put(key, body):
+    with _cache_lock:
+        _response_cache[key] = body
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def bump_hdr_version():
+    """ヘッダー / 明細を書き換えたら呼ぶ（古いキャッシュは使われなくなる）"""
+    global _hdr_version
+    with _cache_lock:
+        _hdr_version += 1
+        _response_cache.clear()
+
+
+def ojsonify(obj):
+    """jsonify の代わり（orjson でエンコードする）"""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+
+# ===== マーク画像の配信 =====
+# ファイル名に内容のハッシュを含めているので、ブラウザ側で無期限にキャッシュさせる。
+# 本番では nginx から直接配信する（README の「デプロイ」参照）。
+
+@app.after_request
+def cache_mark_images(response):
+    if request.path.startswith("/static/mark_images/") and response.status_code < 400:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 # ===== ページルーティング =====
 
 @app.route("/")
@@ -119,79 +502,14 @@ def api_get_hainyu(hainyu_id):
     conn = get_db()
     cur = conn.cursor()
 
-    # ヘッダー
-    cur.execute(
-        """
-        SELECT
-            hainyu_id,
-            date,
-            shipper,
-            dest,
-            item_name,
-            mark,
-            mark_image
-        FROM hainyu_headers
-        WHERE hainyu_id = ?
-        """,
-        (hainyu_id,),
-    )
-    header_row = cur.fetchone()
-
-    if not header_row:
-        conn.close()
-        return jsonify({"error": "not found"}), 404
+    # ヘッダーと明細を 1 クエリで JSON に組み立てる（SQLite の JSON 関数）
+    cur.execute(SQL_GET_HAINYU, (hainyu_id,))
+    row = cur.fetchone()
 
-    # 明細
-    cur.execute(
-        """
-        SELECT
-            id,
-            package_type,
-            no_from,
-            no_to,
-            qty,
-            L,
-            W,
-            H,
-            weight_kg,
-            m3
-        FROM hainyu_items
-        WHERE hainyu_id = ?
-        ORDER BY id
-        """,
-        (hainyu_id,),
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    header = {
-        "hainyu_id": header_row["hainyu_id"],
-        "date": header_row["date"],
-        "shipper": header_row["shipper"],
-        "dest": header_row["dest"],
-        "itemName": header_row["item_name"],
-        "mark": header_row["mark"],
-        "markImage": header_row["mark_image"],  # ★ 画像パス
-    }
-
-    items = []
-    for r in rows:
-        items.append(
-            {
-                "id": r["id"],
-                "packageType": r["package_type"],
-                "noFrom": r["no_from"],
-                "noTo": r["no_to"],
-                "qty": r["qty"],
-                "L": r["L"],
-                "W": r["W"],
-                "H": r["H"],
-                "weightKg": r["weight_kg"],
-                "m3": r["m3"],
-            }
-        )
+    if not row:
+        return ojsonify({"error": "not found"}), 404
 
-    return jsonify({"header": header, "items": items})
+    return Response(row[0], mimetype="application/json")
 
 
 # ===== API: 搬入データ 登録 / 更新 =====
@@ -212,59 +530,53 @@ def api_save_hainyu(hainyu_id):
     conn = get_db()
     cur = conn.cursor()
 
-    # ヘッダー upsert（mark_image はここでは触らない）
-    cur.execute(
-        """
-        INSERT INTO hainyu_headers (hainyu_id, date, shipper, dest, item_name, mark)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(hainyu_id) DO UPDATE SET
-          date      = excluded.date,
-          shipper   = excluded.shipper,
-          dest      = excluded.dest,
-          item_name = excluded.item_name,
-          mark      = excluded.mark
-        """,
-        (hainyu_id, date, shipper, dest, item_name, mark),
-    )
-
-    # 明細は一度削除してから挿入し直し（単純化のため）
-    cur.execute("DELETE FROM hainyu_items WHERE hainyu_id = ?", (hainyu_id,))
-
-    for it in items:
+    rows = [
+        (
+            hainyu_id,
+            it.get("packageType"),
+            it.get("noFrom"),
+            it.get("noTo"),
+            it.get("qty"),
+            it.get("L"),
+            it.get("W"),
+            it.get("H"),
+            it.get("weightKg"),
+            it.get("m3"),
+        )
+        for it in items
+    ]
+    items_hash = hashlib.blake2b(
+        json.dumps(items, sort_keys=True).encode()
+    ).hexdigest()
+
+    # ヘッダー・明細の書き込みを 1 トランザクションにまとめる（fsync は COMMIT 時の 1 回）
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(SQL_GET_ITEMS_HASH, (hainyu_id,))
+        hash_row = cur.fetchone()
+        stored_hash = hash_row["items_hash"] if hash_row else None
+
+        # ヘッダー upsert（mark_image はここでは触らない）
         cur.execute(
-            """
-            INSERT INTO hainyu_items (
-                hainyu_id,
-                package_type,
-                no_from,
-                no_to,
-                qty,
-                L,
-                W,
-                H,
-                weight_kg,
-                m3
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                hainyu_id,
-                it.get("packageType"),
-                it.get("noFrom"),
-                it.get("noTo"),
-                it.get("qty"),
-                it.get("L"),
-                it.get("W"),
-                it.get("H"),
-                it.get("weightKg"),
-                it.get("m3"),
-            ),
+            SQL_UPSERT_HEADER,
+            (hainyu_id, date, shipper, dest, item_name, mark),
         )
 
-    conn.commit()
-    conn.close()
+        # 明細は一度削除してから挿入し直し（単純化のため）
+        # 前回保存時と内容が同じなら何もしない（ハッシュも集計値もそのまま）
+        if stored_hash != items_hash:
+            cur.execute(SQL_DELETE_ITEMS, (hainyu_id,))
+            cur.executemany(SQL_INSERT_ITEM, rows)
+            # ハッシュと集計値（件数・数量・m3・重量）をヘッダーに反映
+            cur.execute(SQL_UPDATE_ITEMS_HASH, (items_hash, hainyu_id))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+    bump_hdr_version()
 
-    return jsonify({"status": "ok"})
+    return ojsonify({"status": "ok"})
 
 
 # ===== API: OCR 用マーク画像アップロード =====
@@ -272,47 +584,90 @@ def api_save_hainyu(hainyu_id):
 # ・元画像を static/mark_images/ に保存
 # ・hainyu_headers.mark_image にパスを保存
 
+def save_upload(f, save_path):
+    """アップロードファイルを保存し、内容の blake2s ハッシュ（先頭 16 桁）を返す（f.save の代わり）
+
+    ディスク上の一時ファイルになっていれば、ハッシュは mmap した元ファイルから取り、
+    コピーは os.sendfile でカーネル内で行う。メモリ上なら 1MiB ずつハッシュしながら書き出す。
+    どちらも保存したファイルを読み直さない。
+    """
+    src = f.stream
+    # SpooledTemporaryFile は fileno() を呼ぶとディスクに書き出されるので、中身を直接見る
+    src = getattr(src, "_file", src)
+    try:
+        src_fd = src.fileno()
+    except (AttributeError, OSError, ValueError):
+        src_fd = None
+
+    with open(save_path, "wb") as dst:
+        if src_fd is not None and hasattr(os, "sendfile"):
+            size = os.fstat(src_fd).st_size
+            h = hashlib.blake2s()
+            if size:
+                with mmap.mmap(src_fd, size, access=mmap.ACCESS_READ) as m:
+                    h.update(m)
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return h.hexdigest()[:16]
+            except OSError:
+                # 通常ファイル間の sendfile に対応していない OS では下の方法で書き直す
+                dst.seek(0)
+                dst.truncate()
+
+        h = hashlib.blake2s()
+        src.seek(0)
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            h.update(chunk)
+            dst.write(chunk)
+    return h.hexdigest()[:16]
+
+
 @app.route("/api/hainyu/<hainyu_id>/mark_image", methods=["POST"])
 def api_upload_mark_image(hainyu_id):
     if "file" not in request.files:
-        return jsonify({"error": "no file"}), 400
+        return ojsonify({"error": "no file"}), 400
 
     f = request.files["file"]
     if f.filename == "":
-        return jsonify({"error": "empty file"}), 400
+        return ojsonify({"error": "empty file"}), 400
 
     # 拡張子決定
     _, ext = os.path.splitext(f.filename)
     ext = ext.lower() or ".jpg"
-    if ext not in [".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"]:
+    if ext not in MARK_IMAGE_EXTS:
         ext = ".jpg"
 
-    # ファイル名: 搬入番号_タイムスタンプ.ext
-    filename = f"{hainyu_id}_{int(time.time())}{ext}"
-
-    # static からの相対パスと実ファイルパス
-    rel_path = os.path.join("mark_images", filename).replace("\\", "/")
-    save_path = os.path.join(MARK_DIR, filename)
-
-    # 元画像のまま保存（リサイズしない）
-    f.save(save_path)
-
-    # DB にパスを保存（ヘッダーが無い場合は空ヘッダーを作る）
+    # 元画像のまま一時ファイルに保存（リサイズしない）
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=MARK_DIR)
+    os.close(fd)
+    try:
+        digest = save_upload(f, tmp_path)
+
+        # ファイル名: 搬入番号_内容のハッシュ.ext（内容が変われば URL も変わるので長期キャッシュできる）
+        filename = f"{hainyu_id}_{digest}{ext}"
+
+        # static からの相対パスと実ファイルパス
+        rel_path = f"mark_images/{filename}"
+        save_path = os.path.join(MARK_DIR, filename)
+        os.chmod(tmp_path, 0o644)  # mkstemp は 0600 で作るので、nginx からも読めるようにする
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # DB にパスを保存（ヘッダーが無い場合は mark_image だけのヘッダーを作る）
     conn = get_db()
     cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO hainyu_headers (hainyu_id, date, shipper, dest, item_name, mark, mark_image)
-        VALUES (?, '', '', '', '', '', ?)
-        ON CONFLICT(hainyu_id) DO UPDATE SET
-          mark_image = excluded.mark_image
-        """,
-        (hainyu_id, rel_path),
-    )
-    conn.commit()
-    conn.close()
+    cur.execute(SQL_UPSERT_MARK_IMAGE, (hainyu_id, rel_path))
+    bump_hdr_version()
 
-    return jsonify(
+    return ojsonify(
         {
             "status": "ok",
             "imagePath": rel_path,
@@ -327,57 +682,51 @@ def api_upload_mark_image(hainyu_id):
 def api_search():
     q = request.args.get("q", "").strip()
 
+    cache_key = ("search", q, _hdr_version)
+    body = cache_get(cache_key)
+    if body is not None:
+        return Response(body, mimetype="application/json")
+
     conn = get_db()
     cur = conn.cursor()
 
-    base_sql = """
-        SELECT
-            hainyu_id,
-            date,
-            shipper,
-            dest,
-            item_name,
-            mark
-        FROM hainyu_headers
-    """
-    params = []
-
-    if q:
+    if FTS_ENABLED and len(q) >= 3:
+        # 全文検索（trigram）。q 全体をフレーズとして部分一致させる
+        phrase = '"' + q.replace('"', '""') + '"'
+        cur.execute(SQL_SEARCH_FTS, (phrase,))
+    elif q:
+        # trigram は 3 文字未満を引けないので、短いキーワード（と全文検索が無い環境）は LIKE で探す
         like = f"%{q}%"
-        base_sql += """
-            WHERE
-                hainyu_id LIKE ?
-                OR shipper LIKE ?
-                OR dest LIKE ?
-                OR item_name LIKE ?
-                OR mark LIKE ?
-        """
-        params.extend([like, like, like, like, like])
-
-    base_sql += " ORDER BY date DESC, hainyu_id ASC LIMIT 100"
-
-    cur.execute(base_sql, params)
+        cur.execute(SQL_SEARCH_LIKE, (like, like, like, like, like))
+    else:
+        cur.execute(SQL_SEARCH)
     rows = cur.fetchall()
-    conn.close()
 
-    result = []
-    for r in rows:
-        result.append(
-            {
-                "hainyuId": r["hainyu_id"],
-                "date": r["date"],
-                "shipper": r["shipper"],
-                "dest": r["dest"],
-                "itemName": r["item_name"],
-                "lastUpdated": r["date"],
-            }
-        )
+    result = [dict(r) for r in rows]
 
-    return jsonify({"results": result})
+    body = orjson.dumps({"results": result})
+    cache_put(cache_key, body)
+    return Response(body, mimetype="application/json")
 
 
 # ===== API: 一覧 / 集計用 =====
 
+def encode_cursor(date, hainyu_id):
+    """一覧のページングカーソル（[date, hainyu_id] の JSON を base64 にした不透明な文字列）"""
+    return base64.urlsafe_b64encode(orjson.dumps([date, hainyu_id])).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """encode_cursor の逆。不正な値なら ValueError"""
+    try:
+        date, hainyu_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError, binascii.Error, orjson.JSONDecodeError) as e:
+        raise ValueError("bad cursor") from e
+    if not (date is None or isinstance(date, str)) or not isinstance(hainyu_id, str):
+        raise ValueError("bad cursor")
+    return date, hainyu_id
+
+
 @app.route("/api/summary", methods=["GET"])
 def api_summary():
     date_from = (request.args.get("dateFrom") or "").strip()
@@ -385,85 +734,114 @@ def api_summary():
     shipper = (request.args.get("shipper") or "").strip()
     dest = (request.args.get("dest") or "").strip()
 
+    # ページング（キーセット方式）。前回レスポンスの nextCursor をそのまま cursor に渡す
+    cursor = request.args.get("cursor") or ""
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            return ojsonify({"error": "bad cursor"}), 400
+    limit = request.args.get("limit", type=int) or SUMMARY_LIMIT
+    limit = max(1, min(limit, SUMMARY_LIMIT))
+
+    cache_key = (
+        "summary", date_from, date_to, shipper, dest, cursor, limit, _hdr_version,
+    )
+    body = cache_get(cache_key)
+    if body is not None:
+        return Response(body, mimetype="application/json")
+
     conn = get_db()
     cur = conn.cursor()
 
-    base_sql = """
-        SELECT
-            h.hainyu_id,
-            h.date,
-            h.shipper,
-            h.dest,
-            h.item_name,
-            h.mark_image,
-            COUNT(i.id)                      AS item_count,
-            COALESCE(SUM(i.qty), 0)          AS total_qty,
-            COALESCE(SUM(i.m3), 0)           AS total_m3,
-            COALESCE(SUM(i.qty * i.weight_kg),0) AS total_weight
-        FROM hainyu_headers h
-        LEFT JOIN hainyu_items i
-          ON i.hainyu_id = h.hainyu_id
-    """
-
     conditions = []
     params = []
 
     if date_from:
-        conditions.append("h.date >= ?")
+        conditions.append("date >= ?")
         params.append(date_from)
 
     if date_to:
-        conditions.append("h.date <= ?")
+        # 画像だけ先に登録したヘッダーは日付が NULL。以前の '' と同じく dateTo だけの絞り込みでは残す
+        conditions.append("(date <= ? OR date IS NULL)")
         params.append(date_to)
 
     if shipper:
-        conditions.append("h.shipper LIKE ?")
+        conditions.append("shipper LIKE ?")
         params.append(f"%{shipper}%")
 
     if dest:
-        conditions.append("h.dest LIKE ?")
+        conditions.append("dest LIKE ?")
         params.append(f"%{dest}%")
 
-    if conditions:
-        base_sql += " WHERE " + " AND ".join(conditions)
-
-    base_sql += """
-        GROUP BY
-            h.hainyu_id,
-            h.date,
-            h.shipper,
-            h.dest,
-            h.item_name,
-            h.mark_image
-        ORDER BY
-            h.date DESC,
-            h.hainyu_id ASC
-        LIMIT 500
-    """
-
-    cur.execute(base_sql, params)
-    rows = cur.fetchall()
-    conn.close()
-
-    results = []
-    for r in rows:
-        results.append(
-            {
-                "hainyuId": r["hainyu_id"],
-                "date": r["date"],
-                "shipper": r["shipper"],
-                "dest": r["dest"],
-                "itemName": r["item_name"],
-                "itemCount": r["item_count"],
-                "totalQty": r["total_qty"],
-                "totalM3": float(r["total_m3"] or 0),
-                "totalWeight": float(r["total_weight"] or 0),
-                "markImage": r["mark_image"],  # LIST側で使わなければ無視してOK
-            }
-        )
-
-    return jsonify({"results": results})
-
+    def build(extra, extra_params):
+        sql = SQL_SUMMARY_BASE
+        where = conditions + extra
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql + SQL_SUMMARY_TAIL, params + extra_params
+
+    # 並び順は date DESC, hainyu_id ASC で、日付なし（NULL）は一番最後。
+    # カーソルより「後」は、日付ありの続き → 日付なしの行、の順に別クエリで取る
+    # （OR date IS NULL を混ぜるとインデックスで範囲検索できず、カーソル手前まで走査してしまう）
+    if after is None:
+        steps = [build([], [])]
+    else:
+        after_date, after_id = after
+        steps = []
+        if after_date is not None:
+            steps.append(
+                build(
+                    ["date <= ?", "(date < ? OR hainyu_id > ?)"],
+                    [after_date, after_date, after_id],
+                )
+            )
+            steps.append(build(["date IS NULL"], []))
+        else:
+            steps.append(build(["date IS NULL", "hainyu_id > ?"], [after_id]))
+
+    def generate():
+        # 結果を一度リストに溜めず、100 行ずつエンコードして流す
+        # 流した分はキャッシュ用に控えておき、最後まで流せたら保存する
+        chunks = [b'{"results":[']
+        yield chunks[0]
+        first = True
+        count = 0
+        last = None
+        for sql, step_params in steps:
+            if count >= limit:
+                break
+            cur.execute(sql, step_params + [limit - count])
+            while True:
+                rows = cur.fetchmany(100)
+                if not rows:
+                    break
+                chunk = b",".join(orjson.dumps(dict(r)) for r in rows)
+                if not first:
+                    chunk = b"," + chunk
+                chunks.append(chunk)
+                yield chunk
+                first = False
+                count += len(rows)
+                last = rows[-1]
+
+        # limit 件ちょうど返したときだけ次ページのカーソルを付ける
+        next_cursor = None
+        if count == limit:
+            next_cursor = encode_cursor(last["date"], last["hainyuId"])
+        chunks.append(b'],"nextCursor":' + orjson.dumps(next_cursor) + b"}")
+        yield chunks[-1]
+        cache_put(cache_key, b"".join(chunks))
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    # 開発用サーバー（リローダー・デバッガ付き）は FLASK_DEV=1 のときだけ使う
+    if os.environ.get("FLASK_DEV"):
+        app.run(debug=True, port=5000)
+    else:
+        raise SystemExit(
+            "本番は gunicorn で起動してください（README の「デプロイ」参照）。"
+            "開発用サーバーは FLASK_DEV=1 python app.py"
+        )